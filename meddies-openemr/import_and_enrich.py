@@ -3,13 +3,39 @@ Combined OpenEMR Import Script
 Creates patients and adds medical history using web session (form-based) approach.
 """
 
+import atexit
+import logging
+import os
+import ssl
+import sys
 import requests
 import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
 import json
+import itertools
+import queue
+import threading
+import time
+import uuid
+from collections import Counter
+from http.cookiejar import LWPCookieJar, LoadError
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
+from urllib.parse import quote_plus
 from datetime import datetime, timedelta
 
+try:
+    import lxml.html
+except ImportError:  # Optional: hidden form fields are then scraped with regexes
+    lxml = None
+
+try:
+    from orjson import loads as json_loads
+except ImportError:  # Optional: patient records are then parsed with stdlib json
+    json_loads = json.loads
+
 # Disable SSL warnings
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -17,8 +43,191 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 OPENEMR_URL = "http://localhost"
 USERNAME = "admin"
 PASSWORD = "pass"
+MAX_WORKERS = 4  # Patients imported concurrently (one web session each)
+COOKIE_JAR_PATH = None  # e.g. ".openemr_cookies.txt" to reuse the login between runs
+LOG_LEVEL = logging.INFO  # logging.DEBUG also shows every added item
 # ---------------------
 
+log = logging.getLogger(__name__)
+
+USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36'
+
+# Precompiled patterns for scraping OpenEMR responses
+CSRF_RE = re.compile(r'name=["\']csrf_token_form["\'][^>]*value=["\']([^"\']+)["\']')
+# Either attribute order in a single scan: name before value, or value before name
+CSRF_ANY_RE = re.compile(
+    r'name=["\']csrf_token_form["\'][^>]*value=["\']([^"\']+)["\']'
+    r'|value=["\']([a-f0-9]{64})["\'][^>]*name=["\']csrf_token_form["\']'
+)
+PID_URL_RE = re.compile(r'pid=(\d+)')
+PID_MULTI_RE = re.compile(
+    r'set_pid\s*=\s*["\']?(\d+)'
+    r'|pid["\']?\s*:\s*["\']?(\d+)'
+    r'|patient_id["\']?\s*=\s*["\']?(\d+)'
+)
+PID_SEARCH_RE = re.compile(r'pid["\']?\s*[:=]\s*["\']?(\d+)["\']?')
+ENC_ID_RE = re.compile(r'EncounterIdArray\[Count\]\s*=\s*(\d+)')
+# The encounter save page passes the one it just created to setEncounter();
+# EncounterIdArray lists all of the patient's encounters, newest date first
+ENC_NEW_RE = re.compile(r'setEncounter\([^,]*,\s*["\']?(\d+)')
+ID_RE = re.compile(r'name=["\']id["\'][^>]*value=["\']([^"\']*)["\']')
+UUID_RE = re.compile(r'name=["\']uuid["\'][^>]*value=["\']([^"\']*)["\']')
+
+# Body OpenEMR returns (HTTP 200) when a form's csrf_token_form is rejected
+CSRF_ERROR_MARKER = 'Authentication Error'
+# Transient failures retried by the connection pool. Connection errors are
+# retried for any method (nothing reached the server); gateway errors only
+# for idempotent methods, so a form POST is never submitted twice.
+HTTP_RETRY = Retry(
+    total=3,
+    connect=3,
+    read=0,
+    status=3,
+    status_forcelist=(502, 503, 504),
+    backoff_factor=0.5,
+    raise_on_status=False,
+)
+
+# Form keys/values made only of these are sent without percent-encoding
+FORM_SAFE_RE = re.compile(r'[A-Za-z0-9_.~-]*\Z')
+FORM_CONTENT_TYPE = 'application/x-www-form-urlencoded'
+
+# Session-wide token the tabbed main page hands to its scripts after login
+CSRF_JS_RE = re.compile(r'csrf_token_js\s*=\s*["\']([0-9a-f]+)["\']')
+
+# Script OpenEMR returns (HTTP 200) instead of a page once the login session
+# timed out: auth.inc.php sends the top window to $GLOBALS['login_screen']
+LOGIN_REDIRECT_RE = re.compile(
+    r"location\.href\s*=\s*'[^']*/(?:login_screen\.php|interface/login/login\.php)")
+# Body globals.php dies with (HTTP 200) once the PHP session itself is gone
+SESSION_MISSING_MARKER = 'Site ID is missing from session data'
+
+# Bytes of a form page scanned for the CSRF token before reading the rest
+CSRF_SCAN_BYTES = 8192
+
+# Seconds a "no such patient" name lookup is remembered
+PATIENT_MISS_TTL = 60
+
+# Begin dates given to imported problems/medications, fixed for the whole run
+RUN_STARTED = datetime.now()
+PROBLEM_BEGIN_DATE = (RUN_STARTED - timedelta(days=90)).strftime("%Y-%m-%d")
+MEDICATION_BEGIN_DATE = (RUN_STARTED - timedelta(days=7)).strftime("%Y-%m-%d %H:%M")
+
+
+def setup_logging(level=LOG_LEVEL):
+    """
+    Send log output through a queue drained by a background thread, so worker
+    threads never block on stdout. The listener is stopped (flushed) at exit.
+    """
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter('%(message)s'))
+    listener = QueueListener(log_queue, stream_handler)
+    
+    log.addHandler(QueueHandler(log_queue))
+    log.setLevel(level)
+    log.propagate = False
+    
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+class UnverifiedTLSAdapter(HTTPAdapter):
+    """
+    HTTPAdapter that builds one unverified SSL context up front and reuses it
+    for every TLS connection, instead of urllib3 creating one per connection.
+    """
+    
+    def __init__(self, *args, **kwargs):
+        # Must exist before HTTPAdapter.__init__ calls init_poolmanager
+        self.ssl_context = ssl.create_default_context()
+        self.ssl_context.check_hostname = False
+        self.ssl_context.verify_mode = ssl.CERT_NONE
+        super().__init__(*args, **kwargs)
+    
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['ssl_context'] = self.ssl_context
+        return super().init_poolmanager(*args, **kwargs)
+
+
+HIDDEN_FIELD_RES = {'csrf_token_form': CSRF_RE, 'id': ID_RE, 'uuid': UUID_RE}
+
+# Insurance form fields as (form key pattern, insurance_data key, default).
+# The form keys depend only on the coverage prefix, so expand them once here.
+INS_FIELDS = (
+    ('form_{}subscriber_relationship', 'subscriber_relationship', 'self'),
+    ('{}subscriber_fname', 'subscriber_fname', ''),
+    ('{}subscriber_lname', 'subscriber_lname', ''),
+    ('{}subscriber_DOB', 'subscriber_DOB', ''),
+    ('form_{}provider', 'provider', ''),
+    ('{}plan_name', 'plan_name', ''),
+    ('{}policy_number', 'policy_number', ''),
+    ('{}group_number', 'group_number', ''),
+    ('{}subscriber_employer', 'subscriber_employer', ''),
+    ('form_copay', 'copay', ''),
+)
+INS_PREFIXES = {'primary': 'i1', 'secondary': 'i2', 'tertiary': 'i3'}
+INS_KEYS = {
+    prefix: tuple(key.format(prefix) for key, _, _ in INS_FIELDS)
+    for prefix in INS_PREFIXES.values()
+}
+INS_VALS = tuple((name, default) for _, name, default in INS_FIELDS)
+
+
+def _extract_hidden_fields(html, names):
+    """
+    Read the values of the named <input> fields from an HTML form page.
+    
+    Uses a single lxml pass over the document when lxml is installed and
+    falls back to one regex scan per field otherwise.
+    
+    Returns:
+        dict of name -> value for the fields that were found
+    """
+    fields = {}
+    if lxml is not None:
+        try:
+            for element in lxml.html.fromstring(html).iter('input'):
+                name = element.get('name')
+                if name in names and name not in fields:
+                    fields[name] = element.get('value', '')
+            return fields
+        except (ValueError, lxml.etree.ParserError):
+            fields = {}
+    
+    for name in names:
+        pattern = HIDDEN_FIELD_RES.get(name) or re.compile(
+            r'name=["\']%s["\'][^>]*value=["\']([^"\']*)["\']' % re.escape(name))
+        match = pattern.search(html)
+        if match:
+            fields[name] = match.group(1)
+    return fields
+
+
+def _body_expired(html):
+    """Return True if a response body is OpenEMR's logged-out answer instead of a page"""
+    return SESSION_MISSING_MARKER in html or LOGIN_REDIRECT_RE.search(html) is not None
+
+
+def _form_quote(text):
+    """quote_plus() a form key/value, skipping values that need no escaping"""
+    return text if FORM_SAFE_RE.match(text) else quote_plus(text)
+
+
+def _encode_form(data):
+    """
+    URL-encode a form dict into a request body, like requests does.
+    
+    Most values are plain dates, codes and enum strings, so only the ones
+    with reserved characters go through quote_plus(). None values are
+    dropped, as requests drops them.
+    """
+    return '&'.join(
+        f'{_form_quote(key)}={_form_quote(str(value))}'
+        for key, value in data.items() if value is not None
+    ).encode()
+
 
 class OpenEMRWebSession:
     """
@@ -26,18 +235,171 @@ class OpenEMRWebSession:
     Uses session cookies for authentication instead of OAuth2 API tokens.
     Handles patient creation and medical history management.
     """
+
+    # OpenEMR picks a new patient's pid with an unlocked SELECT MAX(pid)+1, so
+    # concurrent saves collide on the unique pid; all sessions create one at a time
+    _create_patient_lock = threading.Lock()
+    
+    # Constant form fields, merged with the per-call values via dict union
+    _MED_TEMPLATE = {
+        'issue': '0',
+        'thisenc': '0',
+        'form_type': '2',
+        'form_active': '1',
+        'form_title_id': '',
+        'form_reaction': 'unassigned',
+        'form_severity_id': 'unassigned',
+        'form_medication[usage_category]': 'community',
+        'form_medication[request_intent]': 'order',
+        'form_diagnosis': '',
+        'form_occur': '0',
+        'form_outcome': '0',
+        'form_subtype': '',
+        'form_classification': '0',
+        'form_verification': 'unconfirmed',
+        'form_referredby': '',
+        'form_destination': '',
+        'form_return': '',
+        'row_reinjury_id': '',
+        'form_save': 'Save'
+    }
+    _PROBLEM_TEMPLATE = {
+        'issue': '0',
+        'thisenc': '0',
+        'form_type': '0',
+        'form_active': '1',
+        'form_title_id': '',
+        'form_end': '',
+        'form_occur': '0',
+        'form_outcome': '0',
+        'form_classification': '0',
+        'form_verification': 'unconfirmed',
+        'form_referredby': '',
+        'form_destination': '',
+        'form_return': '',
+        'form_save': 'Save'
+    }
+    _ALLERGY_TEMPLATE = {
+        'issue': '0',
+        'thisenc': '0',
+        'form_type': '3',
+        'form_active': '1',
+        'form_title_id': '',
+        'form_end': '',
+        'form_occur': '0',
+        'form_outcome': '0',
+        'form_verification': 'unconfirmed',
+        'form_comments': '',
+        'form_save': 'Save'
+    }
+    _VITALS_TEMPLATE = {
+        'process': 'true',
+        'activity': '1',
+        'BMI': '',
+        'BMI_status': '',
+        'head_circ': '',
+        'waist_circ': '',
+        'oxygen_flow_rate': '',
+        'inhaled_oxygen_concentration': '',
+    }
     
-    def __init__(self, base_url, username, password):
+    def __init__(self, base_url, username, password, cookie_jar_path=None, adapter=None):
         self.base_url = base_url.rstrip('/')
         self.username = username
         self.password = password
+        
+        # Endpoint URLs, built once since base_url never changes
+        self._url_login_page = f"{self.base_url}/interface/login/login.php"
+        self._url_login = f"{self.base_url}/interface/main/main_screen.php?auth=login&site=default"
+        self._url_demo = f"{self.base_url}/interface/patient_file/summary/demographics.php"
+        self._url_demo_full = f"{self.base_url}/interface/patient_file/summary/demographics_full.php"
+        self._url_new_patient_form = f"{self.base_url}/interface/new/new_comprehensive.php"
+        self._url_new_patient_save = f"{self.base_url}/interface/new/new_comprehensive_save.php"
+        self._url_find = f"{self.base_url}/interface/patient_file/find_interface/find_interface.php"
+        self._url_issue = f"{self.base_url}/interface/patient_file/summary/add_edit_issue.php"
+        self._url_issue_forms = {
+            issue_type: f"{self._url_issue}?issue=0&thistype={issue_type}"
+            for issue_type in ('medication', 'medical_problem', 'allergy')
+        }
+        self._url_enc_new = f"{self.base_url}/interface/forms/newpatient/new.php?autoloaded=1&calenc="
+        self._url_enc_save = f"{self.base_url}/interface/forms/newpatient/save.php"
+        self._url_encounter_top = f"{self.base_url}/interface/patient_file/encounter/encounter_top.php"
+        self._url_vitals_new = f"{self.base_url}/interface/forms/vitals/new.php"
+        self._url_vitals_save = f"{self.base_url}/interface/forms/vitals/save.php"
+        self._url_history = f"{self.base_url}/interface/patient_file/history/history_full.php"
+        # Smallest page behind the login check, used to test a restored session
+        self._url_session_check = f"{self.base_url}/interface/main/blank.php"
+        # Per-request headers for each form POST, keyed by the form page it is sent from
+        self._form_headers = {
+            form_url: {'Referer': form_url, 'Content-Type': FORM_CONTENT_TYPE}
+            for form_url in (self._url_new_patient_form, *self._url_issue_forms.values(),
+                             self._url_enc_new, self._url_vitals_new, self._url_history,
+                             self._url_demo_full)
+        }
         self.session = requests.Session()
+        # Pooled keep-alive connections to the OpenEMR host, one per worker.
+        # Worker sessions pass in the main session's adapter so every thread
+        # shares this pool while keeping its own cookies (PHP session).
+        if adapter is None:
+            adapter = UnverifiedTLSAdapter(pool_connections=4, pool_maxsize=MAX_WORKERS,
+                                           pool_block=False, max_retries=HTTP_RETRY)
+        self.adapter = adapter
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.verify = False
+        # Constant headers for every request; form POSTs add their
+        # prebuilt Referer/Content-Type pair from _form_headers.
+        self.session.headers.update({
+            'User-Agent': USER_AGENT,
+            'Connection': 'keep-alive',
+            'Origin': self.base_url,
+        })
+        # OpenEMR's default CSRF token is per login session, not per form
         self.csrf_token = None
+        # Patient/encounter currently active in the server-side PHP session
+        self._active_pid = None
+        self._active_encounter = None
+        # CSRF tokens are session-scoped, keyed by form path (query string dropped)
+        self._csrf_cache = {}
+        self._relogging = False
+        # (fname, lname) -> (pid or None, lookup time) for find_patient_by_name
+        self._name_pid_cache = {}
+        
+        # Optionally persist the session cookie so reruns can skip the login
+        self.cookie_jar = None
+        self._restored_session = False
+        if cookie_jar_path:
+            self.cookie_jar = LWPCookieJar(str(cookie_jar_path))
+            if Path(cookie_jar_path).exists():
+                try:
+                    self.cookie_jar.load(ignore_discard=True)
+                except (LoadError, OSError) as e:
+                    log.warning("  ! Could not load saved cookies: %s", e)
+            self.session.cookies = self.cookie_jar
+            self._restored_session = any(c.name == 'OpenEMR' for c in self.cookie_jar)
+        
+    def login(self, force=False):
+        """
+        Login via web form and get session cookie + CSRF token.
+        
+        A session restored from cookie_jar_path is checked with one small
+        request and reused if still valid; if it expires later on, requests
+        log in again transparently. Pass force=True to always start a fresh
+        login session.
+        """
+        if self._restored_session and not force:
+            if self._session_alive():
+                log.info("  ✓ Reusing saved web session")
+                return True
+            log.warning("  ! Saved web session has expired, logging in again")
         
-    def login(self):
-        """Login via web form and get session cookie + CSRF token"""
-        login_page_url = f"{self.base_url}/interface/login/login.php"
-        login_url = f"{self.base_url}/interface/main/main_screen.php?auth=login&site=default"
+        # A new login session invalidates everything tied to the old one
+        self._restored_session = False
+        self.session.cookies.clear()
+        self._reset_session_state()
+        
+        login_page_url = self._url_login_page
+        login_url = self._url_login
         
         login_data = {
             'new_login_session_management': '1',
@@ -47,59 +409,212 @@ class OpenEMRWebSession:
             'languageChoice': '1'
         }
         
-        headers = {
-            'Content-Type': 'application/x-www-form-urlencoded',
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36'
-        }
-        
         try:
             # Get login page first
-            self.session.get(login_page_url, verify=False)
+            self.session.get(login_page_url)
             
             # Post login
-            response = self.session.post(login_url, data=login_data, headers=headers, 
-                                         verify=False, allow_redirects=True)
+            response = self.session.post(login_url, data=login_data, allow_redirects=True)
+            
+            # The redirect lands on tabs/main.php, which embeds the session's token
+            match = CSRF_JS_RE.search(response.text)
+            if match:
+                self.csrf_token = match.group(1)
             
-            cookies = self.session.cookies.get_dict()
-            if 'OpenEMR' in cookies:
-                print(f"  ✓ Web login successful")
+            cookie_names = [cookie.name for cookie in self.session.cookies]
+            if 'OpenEMR' in cookie_names:
+                if self.cookie_jar is not None:
+                    self._save_cookies()
+                log.info("  ✓ Web login successful")
                 return True
             else:
-                print(f"  ! Login may have failed. Cookies: {list(cookies.keys())}")
+                log.warning("  ! Login may have failed. Cookies: %s", cookie_names)
                 return True
                 
         except Exception as e:
-            print(f"  ✗ Login error: {e}")
+            log.error("  ✗ Login error: %s", e)
+            return False
+    
+    def _save_cookies(self):
+        """Save the cookie jar readable by the owner only, since it holds a live EMR login"""
+        path = self.cookie_jar.filename
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+        os.chmod(path, 0o600)  # also tighten a jar left by an earlier run
+        self.cookie_jar.save(ignore_discard=True)
+    
+    def _reset_session_state(self):
+        """Forget the state mirrored from the PHP session (CSRF tokens, active patient/encounter)"""
+        self.csrf_token = None
+        self._csrf_cache.clear()
+        self._active_pid = None
+        self._active_encounter = None
+    
+    def _session_alive(self):
+        """Return True if the current cookies still belong to a logged-in session"""
+        try:
+            response = self.session.get(self._url_session_check)
+        except requests.RequestException as e:
+            log.warning("  ! Could not check saved web session: %s", e)
             return False
+        return response.status_code == 200 and not self._session_expired(response)
+    
+    def _session_expired(self, response, check_body=True):
+        """Return True if OpenEMR answered with its login page instead of the request"""
+        if '/interface/login/login.php' in response.url:
+            return True
+        return check_body and _body_expired(response.text)
+    
+    def _send(self, method, url, **kwargs):
+        """
+        Send a request, retrying once if the session expired or the cached
+        CSRF token was rejected.
+        
+        An expired session is logged in again and the previously active
+        patient/encounter restored. Either way the retry swaps a fresh
+        csrf_token_form (fetched from the Referer form page) into the body.
+        """
+        response = self._request(method, url, **kwargs)
+        if self._relogging:
+            return response
+        
+        # Streamed bodies are left unread, so only the final URL can be checked
+        check_body = not kwargs.get('stream', False)
+        if not self._session_expired(response, check_body):
+            data = kwargs.get('data')
+            if (isinstance(data, dict) and 'csrf_token_form' in data
+                    and (response.status_code in (403, 419) or CSRF_ERROR_MARKER in response.text)):
+                # Stale cached token: refetch it from the form page and retry once
+                form_url = (kwargs.get('headers') or {}).get('Referer', url)
+                self.invalidate_csrf(form_url)
+                token = self.get_csrf_token(form_url)
+                if token:
+                    kwargs['data'] = {**data, 'csrf_token_form': token}
+                    response = self._request(method, url, **kwargs)
+            return response
+        
+        if not self._relogin():
+            return response
+        data = kwargs.get('data')
+        if isinstance(data, dict) and 'csrf_token_form' in data:
+            form_url = (kwargs.get('headers') or {}).get('Referer', url)
+            kwargs['data'] = {**data, 'csrf_token_form': self.get_csrf_token(form_url)}
+        return self._request(method, url, **kwargs)
+    
+    def _relogin(self):
+        """Log in again after the session expired, restoring the active patient/encounter"""
+        log.warning("  ! Web session expired, logging in again")
+        active_pid, active_encounter = self._active_pid, self._active_encounter
+        self._relogging = True
+        try:
+            if not self.login(force=True):
+                return False
+            if active_pid is not None:
+                self.set_active_patient(active_pid)
+            if active_encounter is not None:
+                self.set_active_encounter(active_encounter)
+            return True
+        finally:
+            self._relogging = False
+    
+    def _request(self, method, url, **kwargs):
+        """Send one request, encoding a dict form body ourselves (see _encode_form)"""
+        data = kwargs.get('data')
+        if isinstance(data, dict):
+            kwargs['data'] = _encode_form(data)
+            headers = kwargs.get('headers') or {}
+            if 'Content-Type' not in headers:
+                kwargs['headers'] = {**headers, 'Content-Type': FORM_CONTENT_TYPE}
+        return self.session.request(method, url, **kwargs)
+    
+    def _get(self, url, **kwargs):
+        """GET with transparent re-login/CSRF refresh (see _send)"""
+        return self._send('GET', url, **kwargs)
+    
+    def _post(self, url, **kwargs):
+        """POST with transparent re-login/CSRF refresh (see _send)"""
+        return self._send('POST', url, **kwargs)
     
     def get_csrf_token(self, page_url):
-        """Extract CSRF token from a page"""
+        """
+        Return the CSRF token for a form page.
+        
+        Uses the session-wide token from login when there is one; otherwise
+        (e.g. a session restored from the cookie jar, or after the token was
+        rejected) the page is scraped once and its token cached per form path.
+        """
+        if self.csrf_token:
+            return self.csrf_token
+        cache_key = page_url.split('?', 1)[0]
+        token = self._csrf_cache.get(cache_key)
+        if token:
+            return token
+        
+        token, expired = self._fetch_csrf_token(page_url)
+        # The streamed GET can't be checked for expiry by _send, so check here
+        if expired and not self._relogging and self._relogin():
+            token = self.csrf_token or self._fetch_csrf_token(page_url)[0]
+        return token
+    
+    def _fetch_csrf_token(self, page_url):
+        """Scrape a form page's CSRF token; returns (token, session_expired)"""
         try:
-            response = self.session.get(page_url, verify=False)
-            if response.status_code == 200:
-                # Look for csrf_token_form in the page
-                match = re.search(r'name=["\']csrf_token_form["\'][^>]*value=["\']([^"\']+)["\']', response.text)
-                if match:
-                    return match.group(1)
-                # Alternative pattern
-                match = re.search(r'value=["\']([a-f0-9]{64})["\'][^>]*name=["\']csrf_token_form["\']', response.text)
-                if match:
-                    return match.group(1)
+            # Stream the page and try the first few KB before reading the rest
+            with self._get(page_url, stream=True) as response:
+                if response.status_code != 200:
+                    return None, False
+                head = response.raw.read(CSRF_SCAN_BYTES, decode_content=True)
+                token = self._csrf_from_page(page_url, head.decode('utf-8', 'replace'))
+                if token:
+                    return token, False
+                body = (head + response.raw.read(decode_content=True)).decode('utf-8', 'replace')
+                token = self._csrf_from_page(page_url, body)
+                return token, token is None and _body_expired(body)
         except Exception as e:
-            print(f"  ! Error getting CSRF token: {e}")
-        return None
+            log.warning("  ! Error getting CSRF token: %s", e)
+        return None, False
+    
+    def _csrf_from_page(self, page_url, html):
+        """Scrape the CSRF token from an already-fetched page and cache it"""
+        # Look for csrf_token_form in the page
+        match = CSRF_ANY_RE.search(html)
+        if not match:
+            return None
+        token = match.group(1) or match.group(2)
+        self._csrf_cache[page_url.split('?', 1)[0]] = token
+        return token
+    
+    def invalidate_csrf(self, page_url):
+        """Drop the cached CSRF token for a form so the next call refetches it"""
+        # A rejected session-wide token falls back to scraping each form page
+        self.csrf_token = None
+        self._csrf_cache.pop(page_url.split('?', 1)[0], None)
+    
+    def _csrf_rejected(self, response, page_url):
+        """Return True (and invalidate the cached token) if OpenEMR rejected the CSRF token"""
+        if CSRF_ERROR_MARKER in response.text:
+            self.invalidate_csrf(page_url)
+            return True
+        return False
     
     def set_active_patient(self, pid):
-        """Set the active patient in the session"""
-        url = f"{self.base_url}/interface/patient_file/summary/demographics.php"
+        """Set the active patient in the session (no-op if already active)"""
+        if self._active_pid == pid:
+            return True
+        
+        url = self._url_demo
         params = {'set_pid': pid}
         
         try:
-            response = self.session.get(url, params=params, verify=False)
+            # Only the status matters; don't download the ~100KB dashboard
+            response = self._get(url, params=params, stream=True)
+            response.close()
             if response.status_code == 200:
+                # Switching patient also clears the session's encounter
+                self._active_pid = pid
+                self._active_encounter = None
                 return True
         except Exception as e:
-            print(f"  ! Error setting patient: {e}")
+            log.warning("  ! Error setting patient: %s", e)
         return False
 
     # ==================== PATIENT CREATION ====================
@@ -129,23 +644,25 @@ class OpenEMRWebSession:
             pid (int) if successful, None if failed
         """
         # Get the new patient form page to get CSRF token
-        form_url = f"{self.base_url}/interface/new/new_comprehensive.php"
-        save_url = f"{self.base_url}/interface/new/new_comprehensive_save.php"
+        form_url = self._url_new_patient_form
+        save_url = self._url_new_patient_save
         
-        # First, get the form page to extract CSRF token
-        try:
-            form_response = self.session.get(form_url, verify=False)
-            if debug:
-                with open('/tmp/new_patient_form.html', 'w') as f:
-                    f.write(form_response.text)
-                print(f"    [DEBUG] Form saved to /tmp/new_patient_form.html")
-        except Exception as e:
-            print(f"    ✗ Error fetching patient form: {e}")
-            return None
+        # Reuse the cached CSRF token; otherwise fetch the form page once for it
+        csrf_token = self.csrf_token or self._csrf_cache.get(form_url)
+        if not csrf_token or debug:
+            try:
+                form_response = self._get(form_url)
+                if debug:
+                    with open('/tmp/new_patient_form.html', 'w') as f:
+                        f.write(form_response.text)
+                    log.info("    [DEBUG] Form saved to /tmp/new_patient_form.html")
+            except Exception as e:
+                log.error("    ✗ Error fetching patient form: %s", e)
+                return None
+            csrf_token = self._csrf_from_page(form_url, form_response.text)
         
-        csrf_token = self.get_csrf_token(form_url)
         if not csrf_token:
-            print("  ✗ Could not get CSRF token for patient form")
+            log.error("  ✗ Could not get CSRF token for patient form")
             return None
         
         # Build form data - matching OpenEMR's new_comprehensive.php expected fields
@@ -185,76 +702,84 @@ class OpenEMRWebSession:
             'create': 'Create New Patient',
         }
         
-        headers = {
-            'Content-Type': 'application/x-www-form-urlencoded',
-            'Origin': self.base_url,
-            'Referer': form_url
-        }
+        headers = self._form_headers[form_url]
+        
+        # Saving a new patient makes it the session's active patient
+        # (new_comprehensive_save.php calls setpid), recorded once its pid is known
+        self._active_pid = None
+        self._active_encounter = None
         
         try:
-            response = self.session.post(save_url, data=form_data, 
-                                        headers=headers, verify=False, allow_redirects=True)
+            with self._create_patient_lock:
+                response = self._post(save_url, data=form_data, headers=headers)
             
             if debug:
                 with open('/tmp/patient_create_response.html', 'w') as f:
                     f.write(response.text)
-                print(f"    [DEBUG] Response saved to /tmp/patient_create_response.html")
-                print(f"    [DEBUG] Final URL: {response.url}")
+                log.info("    [DEBUG] Response saved to /tmp/patient_create_response.html")
+                log.info("    [DEBUG] Final URL: %s", response.url)
+            
+            if self._csrf_rejected(response, form_url):
+                log.error("    ✗ Failed to create patient: CSRF token rejected")
+                return None
             
             if response.status_code == 200:
                 # Check for error messages in response
                 response_text = response.text
                 if 'ERROR:' in response_text:
-                    print(f"    ✗ Server error: {response_text[:200]}")
+                    log.error("    ✗ Server error: %s", response_text[:200])
                     return None
                 
                 # Try to extract the new patient ID from response or URL
                 pid = self._extract_pid_from_response(response)
                 
                 if pid:
-                    print(f"    ✓ Created Patient: {patient_data.get('fname', '')} {patient_data.get('lname', '')} (PID: {pid})")
+                    self._active_pid = pid
+                    log.info("    ✓ Created Patient: %s %s (PID: %s)", patient_data.get('fname', ''), patient_data.get('lname', ''), pid)
                     return pid
                 else:
                     # Patient might be created, try to find by name
-                    pid = self.find_patient_by_name(patient_data.get('fname', ''), patient_data.get('lname', ''))
+                    # Search fresh: a cached result predates this patient
+                    fname, lname = patient_data.get('fname', ''), patient_data.get('lname', '')
+                    self._name_pid_cache.pop((fname, lname), None)
+                    pid = self.find_patient_by_name(fname, lname)
                     if pid:
-                        print(f"    ✓ Created Patient: {patient_data.get('fname', '')} {patient_data.get('lname', '')} (PID: {pid})")
+                        log.info("    ✓ Created Patient: %s %s (PID: %s)", patient_data.get('fname', ''), patient_data.get('lname', ''), pid)
                         return pid
-                    print(f"    ? Patient may have been created, but couldn't confirm PID")
+                    log.warning("    ? Patient may have been created, but couldn't confirm PID")
                     return None
             else:
-                print(f"    ✗ Failed to create patient: HTTP {response.status_code}")
+                log.error("    ✗ Failed to create patient: HTTP %s", response.status_code)
                 return None
                 
         except Exception as e:
-            print(f"    ✗ Patient creation error: {e}")
+            log.error("    ✗ Patient creation error: %s", e)
             return None
     
     def _extract_pid_from_response(self, response):
         """Extract patient ID from response URL or content"""
         # Check URL for pid parameter
-        if 'pid=' in response.url:
-            match = re.search(r'pid=(\d+)', response.url)
-            if match:
-                return int(match.group(1))
-        
-        # Check response text for pid
-        patterns = [
-            r'set_pid\s*=\s*["\']?(\d+)["\']?',
-            r'pid["\']?\s*:\s*["\']?(\d+)["\']?',
-            r'patient_id["\']?\s*=\s*["\']?(\d+)["\']?',
-        ]
+        match = PID_URL_RE.search(response.url)
+        if match:
+            return int(match.group(1))
         
-        for pattern in patterns:
-            match = re.search(pattern, response.text)
-            if match:
-                return int(match.group(1))
+        # Check response text for pid (single scan over all known spellings)
+        match = PID_MULTI_RE.search(response.text)
+        if match:
+            return int(next(group for group in match.groups() if group))
         
         return None
     
     def find_patient_by_name(self, fname, lname):
-        """Search for a patient by name and return their PID"""
-        search_url = f"{self.base_url}/interface/patient_file/find_interface/find_interface.php"
+        """Search for a patient by name and return their PID (results are cached)"""
+        key = (fname, lname)
+        cached = self._name_pid_cache.get(key)
+        if cached:
+            pid, looked_up_at = cached
+            if pid is not None or time.monotonic() - looked_up_at < PATIENT_MISS_TTL:
+                return pid
+        
+        search_url = self._url_find
         
         try:
             # Try to search
@@ -262,194 +787,154 @@ class OpenEMRWebSession:
                 'fname': fname,
                 'lname': lname,
             }
-            response = self.session.get(search_url, params=params, verify=False)
+            response = self._get(search_url, params=params)
             
             if response.status_code == 200:
                 # Look for pid in results
-                match = re.search(r'pid["\']?\s*[:=]\s*["\']?(\d+)["\']?', response.text)
-                if match:
-                    return int(match.group(1))
+                match = PID_SEARCH_RE.search(response.text)
+                pid = int(match.group(1)) if match else None
+                self._name_pid_cache[key] = (pid, time.monotonic())
+                return pid
         except Exception as e:
             pass
         
         return None
+    
+    def invalidate_patient_cache(self):
+        """Forget all cached find_patient_by_name results"""
+        self._name_pid_cache.clear()
 
     # ==================== MEDICAL HISTORY ====================
     
     def add_medication(self, pid, title, dosage_instructions="", begin_date=None, end_date=None, comments=""):
         """Add a medication to a patient via the web interface."""
-        self.set_active_patient(pid)
+        return self.add_issues_bulk(pid, [('medication', {
+            'title': title,
+            'dosage_instructions': dosage_instructions,
+            'begin_date': begin_date,
+            'end_date': end_date,
+            'comments': comments,
+        })]) == 1
+    
+    def add_problem(self, pid, title, icd10="", begin_date=None, comments=""):
+        """Add a medical problem/diagnosis via the web interface."""
+        return self.add_issues_bulk(pid, [('medical_problem', {
+            'title': title,
+            'icd10': icd10,
+            'begin_date': begin_date,
+            'comments': comments,
+        })]) == 1
+    
+    def add_allergy(self, pid, title, reaction="", severity="", begin_date=None):
+        """Add an allergy via the web interface."""
+        return self.add_issues_bulk(pid, [('allergy', {
+            'title': title,
+            'reaction': reaction,
+            'severity': severity,
+            'begin_date': begin_date,
+        })]) == 1
+    
+    def add_issues_bulk(self, pid, issues):
+        """
+        Add several medications/problems/allergies to one patient.
         
-        add_url = f"{self.base_url}/interface/patient_file/summary/add_edit_issue.php"
-        params = {'issue': '0', 'thistype': 'medication'}
+        The patient is made active once and the form POSTs are sent back to
+        back over the same connection, with no form GET in between once the
+        issue form's CSRF token is cached.
         
-        csrf_token = self.get_csrf_token(f"{add_url}?issue=0&thistype=medication")
-        if not csrf_token:
-            print("    ! Could not get CSRF token for medication form")
-            return False
+        Args:
+            pid: Patient ID
+            issues: list of (issue_type, fields) tuples where issue_type is
+                'medication', 'medical_problem' or 'allergy' and fields holds
+                the keyword arguments of add_medication/add_problem/add_allergy
+                
+        Returns:
+            Number of issues added (issues without a title are skipped)
+        """
+        # An issue needs a title; don't spend a POST on one without it
+        issues = [(issue_type, fields) for issue_type, fields in issues if fields.get('title')]
+        if not issues:
+            return 0
+        
+        builders = {
+            'medication': (self._medication_form_data, 'Medication'),
+            'medical_problem': (self._problem_form_data, 'Problem'),
+            'allergy': (self._allergy_form_data, 'Allergy'),
+        }
+        
+        self.set_active_patient(pid)
         
+        added = 0
+        for issue_type, fields in issues:
+            build_form_data, label = builders[issue_type]
+            issue_url = self._url_issue_forms[issue_type]
+            
+            csrf_token = self.get_csrf_token(issue_url)
+            if not csrf_token:
+                log.warning("    ! Could not get CSRF token for %s form", label.lower())
+                continue
+            
+            form_data = build_form_data(pid, csrf_token, **fields)
+            headers = self._form_headers[issue_url]
+            
+            try:
+                response = self._post(issue_url, data=form_data, headers=headers)
+                if self._csrf_rejected(response, self._url_issue):
+                    log.error("      ✗ Failed %s: CSRF token rejected", label)
+                elif response.status_code == 200:
+                    log.debug("      ✓ Added %s: %s", label, fields['title'])
+                    added += 1
+                else:
+                    log.error("      ✗ Failed %s: HTTP %s", label, response.status_code)
+            except Exception as e:
+                log.error("      ✗ %s error: %s", label, e)
+        
+        return added
+    
+    def _medication_form_data(self, pid, csrf_token, title, dosage_instructions="", begin_date=None, end_date=None, comments=""):
+        """Build the add_edit_issue.php form body for a medication"""
         if begin_date is None:
             begin_date = datetime.now().strftime("%Y-%m-%d %H:%M")
         if end_date is None:
             end_date = ""
         
-        form_data = {
+        return self._MED_TEMPLATE | {
             'csrf_token_form': csrf_token,
-            'issue': '0',
             'thispid': str(pid),
-            'thisenc': '0',
-            'form_type': '2',
-            'form_active': '1',
             'form_title': title,
-            'form_title_id': '',
             'form_begin': begin_date,
             'form_end': end_date,
-            'form_reaction': 'unassigned',
-            'form_severity_id': 'unassigned',
-            'form_medication[usage_category]': 'community',
-            'form_medication[request_intent]': 'order',
             'form_medication[drug_dosage_instructions]': dosage_instructions,
             'form_comments': comments,
-            'form_diagnosis': '',
-            'form_occur': '0',
-            'form_outcome': '0',
-            'form_subtype': '',
-            'form_classification': '0',
-            'form_verification': 'unconfirmed',
-            'form_referredby': '',
-            'form_destination': '',
-            'form_return': '',
-            'row_reinjury_id': '',
-            'form_save': 'Save'
-        }
-        
-        headers = {
-            'Content-Type': 'application/x-www-form-urlencoded',
-            'Origin': self.base_url,
-            'Referer': f"{add_url}?issue=0&thistype=medication"
         }
-        
-        try:
-            response = self.session.post(f"{add_url}?issue=0&thistype=medication", 
-                                         data=form_data, headers=headers, verify=False)
-            if response.status_code == 200:
-                print(f"      ✓ Added Medication: {title}")
-                return True
-            else:
-                print(f"      ✗ Failed Medication: HTTP {response.status_code}")
-                return False
-        except Exception as e:
-            print(f"      ✗ Medication error: {e}")
-            return False
     
-    def add_problem(self, pid, title, icd10="", begin_date=None, comments=""):
-        """Add a medical problem/diagnosis via the web interface."""
-        self.set_active_patient(pid)
-        
-        add_url = f"{self.base_url}/interface/patient_file/summary/add_edit_issue.php"
-        csrf_token = self.get_csrf_token(f"{add_url}?issue=0&thistype=medical_problem")
-        
-        if not csrf_token:
-            print("    ! Could not get CSRF token for problem form")
-            return False
-        
+    def _problem_form_data(self, pid, csrf_token, title, icd10="", begin_date=None, comments=""):
+        """Build the add_edit_issue.php form body for a medical problem"""
         if begin_date is None:
             begin_date = datetime.now().strftime("%Y-%m-%d")
         
-        form_data = {
+        return self._PROBLEM_TEMPLATE | {
             'csrf_token_form': csrf_token,
-            'issue': '0',
             'thispid': str(pid),
-            'thisenc': '0',
-            'form_type': '0',
-            'form_active': '1',
             'form_title': title,
-            'form_title_id': '',
             'form_begin': begin_date,
-            'form_end': '',
             'form_diagnosis': icd10,
-            'form_occur': '0',
-            'form_outcome': '0',
-            'form_classification': '0',
-            'form_verification': 'unconfirmed',
             'form_comments': comments,
-            'form_referredby': '',
-            'form_destination': '',
-            'form_return': '',
-            'form_save': 'Save'
         }
-        
-        headers = {
-            'Content-Type': 'application/x-www-form-urlencoded',
-            'Origin': self.base_url,
-            'Referer': f"{add_url}?issue=0&thistype=medical_problem"
-        }
-        
-        try:
-            response = self.session.post(f"{add_url}?issue=0&thistype=medical_problem",
-                                         data=form_data, headers=headers, verify=False)
-            if response.status_code == 200:
-                print(f"      ✓ Added Problem: {title}")
-                return True
-            else:
-                print(f"      ✗ Failed Problem: HTTP {response.status_code}")
-                return False
-        except Exception as e:
-            print(f"      ✗ Problem error: {e}")
-            return False
     
-    def add_allergy(self, pid, title, reaction="", severity="", begin_date=None):
-        """Add an allergy via the web interface."""
-        self.set_active_patient(pid)
-        
-        add_url = f"{self.base_url}/interface/patient_file/summary/add_edit_issue.php"
-        csrf_token = self.get_csrf_token(f"{add_url}?issue=0&thistype=allergy")
-        
-        if not csrf_token:
-            print("    ! Could not get CSRF token for allergy form")
-            return False
-        
+    def _allergy_form_data(self, pid, csrf_token, title, reaction="", severity="", begin_date=None):
+        """Build the add_edit_issue.php form body for an allergy"""
         if begin_date is None:
             begin_date = datetime.now().strftime("%Y-%m-%d")
         
-        form_data = {
+        return self._ALLERGY_TEMPLATE | {
             'csrf_token_form': csrf_token,
-            'issue': '0',
             'thispid': str(pid),
-            'thisenc': '0',
-            'form_type': '3',
-            'form_active': '1',
             'form_title': title,
-            'form_title_id': '',
             'form_begin': begin_date,
-            'form_end': '',
             'form_reaction': reaction or 'unassigned',
             'form_severity_id': severity or 'unassigned',
-            'form_occur': '0',
-            'form_outcome': '0',
-            'form_verification': 'unconfirmed',
-            'form_comments': '',
-            'form_save': 'Save'
-        }
-        
-        headers = {
-            'Content-Type': 'application/x-www-form-urlencoded',
-            'Origin': self.base_url,
-            'Referer': f"{add_url}?issue=0&thistype=allergy"
         }
-        
-        try:
-            response = self.session.post(f"{add_url}?issue=0&thistype=allergy",
-                                         data=form_data, headers=headers, verify=False)
-            if response.status_code == 200:
-                print(f"      ✓ Added Allergy: {title}")
-                return True
-            else:
-                print(f"      ✗ Failed Allergy: HTTP {response.status_code}")
-                return False
-        except Exception as e:
-            print(f"      ✗ Allergy error: {e}")
-            return False
 
     # ==================== ENCOUNTERS & VITALS ====================
     
@@ -470,12 +955,12 @@ class OpenEMRWebSession:
         """
         self.set_active_patient(pid)
         
-        form_url = f"{self.base_url}/interface/forms/newpatient/new.php?autoloaded=1&calenc="
-        save_url = f"{self.base_url}/interface/forms/newpatient/save.php"
+        form_url = self._url_enc_new
+        save_url = self._url_enc_save
         
         csrf_token = self.get_csrf_token(form_url)
         if not csrf_token:
-            print("    ! Could not get CSRF token for encounter form")
+            log.warning("    ! Could not get CSRF token for encounter form")
             return None
         
         form_data = {
@@ -490,35 +975,44 @@ class OpenEMRWebSession:
             'class_code': 'AMB',  # Ambulatory
         }
         
-        headers = {
-            'Content-Type': 'application/x-www-form-urlencoded',
-            'Origin': self.base_url,
-            'Referer': form_url
-        }
+        headers = self._form_headers[form_url]
+        
+        # Saving a new encounter changes the session's active encounter
+        self._active_encounter = None
         
         try:
-            response = self.session.post(save_url, data=form_data, headers=headers, verify=False)
+            response = self._post(save_url, data=form_data, headers=headers)
+            if self._csrf_rejected(response, form_url):
+                log.error("      ✗ Failed Encounter: CSRF token rejected")
+                return None
             if response.status_code == 200:
                 # Extract encounter ID from response
-                match = re.search(r'EncounterIdArray\[Count\]\s*=\s*(\d+)', response.text)
+                match = ENC_NEW_RE.search(response.text) or ENC_ID_RE.search(response.text)
                 if match:
                     enc_id = int(match.group(1))
-                    print(f"      ✓ Created Encounter: {date} - {reason} (ID: {enc_id})")
+                    # save.php already made it the session's active encounter
+                    self._active_encounter = enc_id
+                    log.debug("      ✓ Created Encounter: %s - %s (ID: %s)", date, reason, enc_id)
                     return enc_id
-            print(f"      ? Encounter may have been created but couldn't confirm ID")
+            log.warning("      ? Encounter may have been created but couldn't confirm ID")
             return None
         except Exception as e:
-            print(f"      ✗ Encounter error: {e}")
+            log.error("      ✗ Encounter error: %s", e)
             return None
     
     def set_active_encounter(self, encounter_id):
-        """Set the active encounter in the session"""
-        url = f"{self.base_url}/interface/patient_file/encounter/encounter_top.php"
+        """Set the active encounter in the session (no-op if already active)"""
+        if self._active_encounter == encounter_id:
+            return True
+        
+        url = self._url_encounter_top
         params = {'set_encounter': encounter_id}
         try:
-            self.session.get(url, params=params, verify=False)
+            self._get(url, params=params, stream=True).close()
+            self._active_encounter = encounter_id
             return True
-        except:
+        except Exception as e:
+            log.warning("  ! Error setting encounter: %s", e)
             return False
     
     def add_vitals(self, pid, encounter_id, vitals_data):
@@ -542,36 +1036,29 @@ class OpenEMRWebSession:
         self.set_active_patient(pid)
         self.set_active_encounter(encounter_id)
         
-        form_url = f"{self.base_url}/interface/forms/vitals/new.php"
-        save_url = f"{self.base_url}/interface/forms/vitals/save.php"
+        form_url = self._url_vitals_new
+        save_url = self._url_vitals_save
         
         # Get the form to extract hidden fields
         try:
-            form_response = self.session.get(form_url, verify=False)
+            form_response = self._get(form_url)
         except Exception as e:
-            print(f"        ! Error fetching vitals form: {e}")
+            log.warning("        ! Error fetching vitals form: %s", e)
             return False
         
-        csrf_token = None
-        csrf_match = re.search(r'name=["\']csrf_token_form["\'][^>]*value=["\']([^"\']+)["\']', form_response.text)
-        if csrf_match:
-            csrf_token = csrf_match.group(1)
+        # Extract hidden field values
+        hidden = _extract_hidden_fields(form_response.text, {'csrf_token_form', 'id', 'uuid'})
+        csrf_token = hidden.get('csrf_token_form')
         
         if not csrf_token:
-            print("        ! Could not get CSRF token for vitals form")
+            log.warning("        ! Could not get CSRF token for vitals form")
             return False
         
-        # Extract hidden field values
-        id_match = re.search(r'name=["\']id["\'][^>]*value=["\']([^"\']*)["\']', form_response.text)
-        uuid_match = re.search(r'name=["\']uuid["\'][^>]*value=["\']([^"\']*)["\']', form_response.text)
-        
-        form_data = {
+        form_data = self._VITALS_TEMPLATE | {
             'csrf_token_form': csrf_token,
-            'id': id_match.group(1) if id_match else '',
-            'uuid': uuid_match.group(1) if uuid_match else '',
+            'id': hidden.get('id', ''),
+            'uuid': hidden.get('uuid', ''),
             'pid': str(pid),
-            'process': 'true',
-            'activity': '1',
             'weight': vitals_data.get('weight', ''),
             'height': vitals_data.get('height', ''),
             'bps': vitals_data.get('bps', ''),
@@ -581,36 +1068,26 @@ class OpenEMRWebSession:
             'temperature': vitals_data.get('temperature', ''),
             'oxygen_saturation': vitals_data.get('oxygen_saturation', ''),
             'note': vitals_data.get('note', ''),
-            'BMI': '',
-            'BMI_status': '',
-            'head_circ': '',
-            'waist_circ': '',
-            'oxygen_flow_rate': '',
-            'inhaled_oxygen_concentration': '',
         }
         
-        headers = {
-            'Content-Type': 'application/x-www-form-urlencoded',
-            'Origin': self.base_url,
-            'Referer': form_url
-        }
+        headers = self._form_headers[form_url]
         
         try:
-            response = self.session.post(save_url, data=form_data, headers=headers, verify=False)
+            response = self._post(save_url, data=form_data, headers=headers)
             if response.status_code == 200:
                 # Check for success indicator (closeTab script)
                 if 'closeTab' in response.text or 'saved' in response.text.lower():
                     bp_str = f"{vitals_data.get('bps', '?')}/{vitals_data.get('bpd', '?')}" if vitals_data.get('bps') else "N/A"
-                    print(f"        ✓ Added Vitals: BP {bp_str}, HR {vitals_data.get('pulse', '?')}, Temp {vitals_data.get('temperature', '?')}")
+                    log.debug("        ✓ Added Vitals: BP %s, HR %s, Temp %s", bp_str, vitals_data.get('pulse', '?'), vitals_data.get('temperature', '?'))
                     return True
                 else:
-                    print(f"        ? Vitals submitted but response unclear")
+                    log.warning("        ? Vitals submitted but response unclear")
                     return True  # Probably succeeded
             else:
-                print(f"        ✗ Failed Vitals: HTTP {response.status_code}")
+                log.error("        ✗ Failed Vitals: HTTP %s", response.status_code)
                 return False
         except Exception as e:
-            print(f"        ✗ Vitals error: {e}")
+            log.error("        ✗ Vitals error: %s", e)
             return False
 
     # ==================== LAB RESULTS (via Direct DB for FHIR) ====================
@@ -640,7 +1117,7 @@ class OpenEMRWebSession:
         try:
             import pymysql
         except ImportError:
-            print("        ! pymysql not installed. Run: pip install pymysql")
+            log.warning("        ! pymysql not installed. Run: pip install pymysql")
             return False
         
         lab_date = lab_data[0].get('date', datetime.now().strftime("%Y-%m-%d"))
@@ -684,25 +1161,27 @@ class OpenEMRWebSession:
             """, (order_id, lab_date, lab_date))
             report_id = cursor.lastrowid
             
-            # 4. Create procedure_result for each lab
-            for lab in lab_data:
-                cursor.execute("""
-                    INSERT INTO procedure_result 
-                    (uuid, procedure_report_id, result_code, result_text, `date`,
-                     result, units, `range`, abnormal, comments, result_status)
-                    VALUES (UNHEX(REPLACE(UUID(),'-','')), %s, %s, %s, %s, 
-                            %s, %s, %s, %s, %s, 'final')
-                """, (
-                    report_id,
-                    lab.get('code', ''),
-                    lab.get('description', ''),
-                    lab_date,
-                    str(lab.get('value', '')),
-                    lab.get('unit', ''),
-                    lab.get('reference_range', ''),
-                    lab.get('abnormal', ''),
-                    lab.get('comments', '')
-                ))
+            # 4. Create procedure_result for each lab in one multi-row INSERT
+            # (pymysql only batches executemany when VALUES is all placeholders,
+            # so the uuid is generated here rather than with UUID() in SQL)
+            cursor.executemany("""
+                INSERT INTO procedure_result 
+                (uuid, procedure_report_id, result_code, result_text, `date`,
+                 result, units, `range`, abnormal, comments, result_status)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """, [(
+                uuid.uuid4().bytes,
+                report_id,
+                lab.get('code', ''),
+                lab.get('description', ''),
+                lab_date,
+                str(lab.get('value', '')),
+                lab.get('unit', ''),
+                lab.get('reference_range', ''),
+                lab.get('abnormal', ''),
+                lab.get('comments', ''),
+                'final'
+            ) for lab in lab_data])
             
             conn.commit()
             cursor.close()
@@ -710,14 +1189,14 @@ class OpenEMRWebSession:
             
             lab_names = [l.get('description', 'Unknown')[:15] for l in lab_data[:3]]
             suffix = "..." if len(lab_data) > 3 else ""
-            print(f"        ✓ Added {len(lab_data)} Lab(s) [Order #{order_id}]: {', '.join(lab_names)}{suffix}")
+            log.debug("        ✓ Added %s Lab(s) [Order #%s]: %s%s", len(lab_data), order_id, ', '.join(lab_names), suffix)
             return True
             
         except pymysql.Error as e:
-            print(f"        ✗ Database error: {e}")
+            log.error("        ✗ Database error: %s", e)
             return False
         except Exception as e:
-            print(f"        ✗ Lab error: {e}")
+            log.error("        ✗ Lab error: %s", e)
             return False
 
     # ==================== MEDICAL/SOCIAL HISTORY ====================
@@ -755,13 +1234,17 @@ class OpenEMRWebSession:
                 - relatives_mental_illness
                 - relatives_suicide
         """
+        # Nothing to save: skip the form round trips
+        if not any(history_data.values()):
+            return False
+        
         self.set_active_patient(pid)
         
-        form_url = f"{self.base_url}/interface/patient_file/history/history_full.php"
+        form_url = self._url_history
         
         csrf_token = self.get_csrf_token(form_url)
         if not csrf_token:
-            print("      ! Could not get CSRF token for history form")
+            log.warning("      ! Could not get CSRF token for history form")
             return False
         
         # Build form data
@@ -793,22 +1276,21 @@ class OpenEMRWebSession:
             'form_relatives_suicide': history_data.get('relatives_suicide', ''),
         }
         
-        headers = {
-            'Content-Type': 'application/x-www-form-urlencoded',
-            'Origin': self.base_url,
-            'Referer': form_url
-        }
+        headers = self._form_headers[form_url]
         
         try:
-            response = self.session.post(form_url, data=form_data, headers=headers, verify=False)
+            response = self._post(form_url, data=form_data, headers=headers)
+            if self._csrf_rejected(response, form_url):
+                log.error("      ✗ Failed History: CSRF token rejected")
+                return False
             if response.status_code == 200:
-                print(f"      ✓ Updated Medical/Social History")
+                log.debug("      ✓ Updated Medical/Social History")
                 return True
             else:
-                print(f"      ✗ Failed History: HTTP {response.status_code}")
+                log.error("      ✗ Failed History: HTTP %s", response.status_code)
                 return False
         except Exception as e:
-            print(f"      ✗ History error: {e}")
+            log.error("      ✗ History error: %s", e)
             return False
 
     # ==================== INSURANCE ====================
@@ -820,7 +1302,7 @@ class OpenEMRWebSession:
         Args:
             pid: Patient ID
             insurance_data: dict with insurance fields:
-                - provider: Insurance company name
+                - provider: Insurance company name (required)
                 - plan_name: Plan name
                 - policy_number: Policy number
                 - group_number: Group number
@@ -831,49 +1313,44 @@ class OpenEMRWebSession:
                 - copay: Copay amount
             insurance_type: "primary", "secondary", or "tertiary"
         """
+        # No coverage on this tier without a provider; skip the form round trips
+        if not insurance_data or not insurance_data.get('provider'):
+            return False
+        
         self.set_active_patient(pid)
         
         # Insurance type prefix
-        prefix = {'primary': 'i1', 'secondary': 'i2', 'tertiary': 'i3'}.get(insurance_type, 'i1')
+        prefix = INS_PREFIXES.get(insurance_type, 'i1')
         
         # Get the demographics edit page
-        form_url = f"{self.base_url}/interface/patient_file/summary/demographics_full.php"
+        form_url = self._url_demo_full
         
         csrf_token = self.get_csrf_token(form_url)
         if not csrf_token:
-            print("      ! Could not get CSRF token for insurance form")
+            log.warning("      ! Could not get CSRF token for insurance form")
             return False
         
-        form_data = {
-            'csrf_token_form': csrf_token,
-            f'form_{prefix}subscriber_relationship': insurance_data.get('subscriber_relationship', 'self'),
-            f'{prefix}subscriber_fname': insurance_data.get('subscriber_fname', ''),
-            f'{prefix}subscriber_lname': insurance_data.get('subscriber_lname', ''),
-            f'{prefix}subscriber_DOB': insurance_data.get('subscriber_DOB', ''),
-            f'form_{prefix}provider': insurance_data.get('provider', ''),
-            f'{prefix}plan_name': insurance_data.get('plan_name', ''),
-            f'{prefix}policy_number': insurance_data.get('policy_number', ''),
-            f'{prefix}group_number': insurance_data.get('group_number', ''),
-            f'{prefix}subscriber_employer': insurance_data.get('subscriber_employer', ''),
-            f'form_copay': insurance_data.get('copay', ''),
-        }
+        form_data = {'csrf_token_form': csrf_token}
+        form_data.update(zip(
+            INS_KEYS[prefix],
+            (insurance_data.get(name, default) for name, default in INS_VALS),
+        ))
         
-        headers = {
-            'Content-Type': 'application/x-www-form-urlencoded',
-            'Origin': self.base_url,
-            'Referer': form_url
-        }
+        headers = self._form_headers[form_url]
         
         try:
-            response = self.session.post(form_url, data=form_data, headers=headers, verify=False)
+            response = self._post(form_url, data=form_data, headers=headers)
+            if self._csrf_rejected(response, form_url):
+                log.error("      ✗ Failed Insurance: CSRF token rejected")
+                return False
             if response.status_code == 200:
-                print(f"      ✓ Added {insurance_type.title()} Insurance: {insurance_data.get('provider', 'Unknown')}")
+                log.debug("      ✓ Added %s Insurance: %s", insurance_type.title(), insurance_data.get('provider', 'Unknown'))
                 return True
             else:
-                print(f"      ✗ Failed Insurance: HTTP {response.status_code}")
+                log.error("      ✗ Failed Insurance: HTTP %s", response.status_code)
                 return False
         except Exception as e:
-            print(f"      ✗ Insurance error: {e}")
+            log.error("      ✗ Insurance error: %s", e)
             return False
 
 
@@ -881,19 +1358,21 @@ class OpenEMRWebSession:
 # ==================== PATIENT DATA LOADER ====================
 # Load patient records from JSONL file for easy management
 
-def load_patients_from_jsonl(filepath=None):
+def iter_patients_from_jsonl(filepath=None):
     """
-    Load patient records from a JSONL file.
+    Stream patient records from a JSONL file, one parsed line at a time.
     
     Each line in the JSONL file should be a complete JSON object representing
     a patient with their demographics, medical history, and encounters.
+    Records are parsed lazily, so files of any size can be imported without
+    holding every patient in memory.
     
     Args:
         filepath: Path to the JSONL file. If None, defaults to 'patients.jsonl'
                   in the same directory as this script.
                   
-    Returns:
-        List of patient dictionaries
+    Yields:
+        Patient dictionaries
     """
     if filepath is None:
         # Default to patients.jsonl in the same directory as this script
@@ -903,27 +1382,38 @@ def load_patients_from_jsonl(filepath=None):
         filepath = Path(filepath)
     
     if not filepath.exists():
-        print(f"  ✗ Patient file not found: {filepath}")
-        return []
+        log.error("  ✗ Patient file not found: %s", filepath)
+        return
     
-    patients = []
-    with open(filepath, 'r', encoding='utf-8') as f:
+    count = 0
+    # Read raw bytes: both orjson and json.loads decode UTF-8 themselves
+    with open(filepath, 'rb') as f:
         for line_num, line in enumerate(f, 1):
             line = line.strip()
             if not line:  # Skip empty lines
                 continue
             try:
-                patient = json.loads(line)
-                patients.append(patient)
+                patient = json_loads(line)
             except json.JSONDecodeError as e:
-                print(f"  ✗ Error parsing line {line_num}: {e}")
+                log.error("  ✗ Error parsing line %s: %s", line_num, e)
                 continue
+            count += 1
+            yield patient
+    
+    log.info("  ✓ Read %s patient(s) from %s", count, filepath.name)
+
+
+def load_patients_from_jsonl(filepath=None):
+    """
+    Load all patient records from a JSONL file (see iter_patients_from_jsonl).
     
-    print(f"  ✓ Loaded {len(patients)} patient(s) from {filepath.name}")
-    return patients
+    Returns:
+        List of patient dictionaries
+    """
+    return list(iter_patients_from_jsonl(filepath))
 
 
-def import_patient_with_history(emr, patient_data):
+def import_patient_with_history(emr, patient_data, counts=None):
     """
     Create a patient and add their complete medical history including
     longitudinal data (multiple encounters with vitals over time).
@@ -931,82 +1421,84 @@ def import_patient_with_history(emr, patient_data):
     Args:
         emr: OpenEMRWebSession instance
         patient_data: dict containing demographics, medical history, and encounters
+        counts: Optional Counter, incremented with the number of problems,
+            medications and encounters of the patient once it is created
         
     Returns:
         pid if successful, None if failed
     """
     full_name = f"{patient_data['fname']} {patient_data.get('mname', '')} {patient_data['lname']}".replace("  ", " ")
-    print(f"\n{'='*60}")
-    print(f"Processing: {full_name}")
-    print(f"{'='*60}")
+    log.info("\n" + "=" * 60)
+    log.info("Processing: %s", full_name)
+    log.info("=" * 60)
     
     # Extract demographics (exclude medical data keys)
     exclude_keys = ['problems', 'medications', 'allergies', 'history', 'insurance', 'encounters']
     demographics = {k: v for k, v in patient_data.items() if k not in exclude_keys}
     
     # Create patient
-    print("  Creating patient record...")
+    log.debug("  Creating patient record...")
     pid = emr.create_patient(demographics)
     
     if not pid:
-        print(f"  ✗ Failed to create patient, skipping medical history")
+        log.error("  ✗ Failed to create patient, skipping medical history")
         return None
     
-    # Add medical problems
     problems = patient_data.get('problems', [])
+    medications = patient_data.get('medications', [])
+    encounters = patient_data.get('encounters', [])
+    if counts is not None:
+        counts['problems'] += len(problems)
+        counts['medications'] += len(medications)
+        counts['encounters'] += len(encounters)
+    
+    # Add medical problems, medications and allergies as one batch
+    issues = []
+    
     if problems:
-        print(f"  Adding {len(problems)} problem(s)...")
-        date_past = (datetime.now() - timedelta(days=90)).strftime("%Y-%m-%d")
-        for problem in problems:
-            emr.add_problem(
-                pid, 
-                problem['title'], 
-                problem.get('icd10', ''), 
-                date_past,
-                problem.get('comments', '')
-            )
+        log.debug("  Adding %s problem(s)...", len(problems))
+        issues += [('medical_problem', {
+            'title': problem['title'],
+            'icd10': problem.get('icd10', ''),
+            'begin_date': PROBLEM_BEGIN_DATE,
+            'comments': problem.get('comments', ''),
+        }) for problem in problems]
     
-    # Add medications
-    medications = patient_data.get('medications', [])
     if medications:
-        print(f"  Adding {len(medications)} medication(s)...")
-        date_past = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d %H:%M")
-        for med in medications:
-            emr.add_medication(
-                pid,
-                med['title'],
-                med.get('dosage', ''),
-                date_past
-            )
+        log.debug("  Adding %s medication(s)...", len(medications))
+        issues += [('medication', {
+            'title': med['title'],
+            'dosage_instructions': med.get('dosage', ''),
+            'begin_date': MEDICATION_BEGIN_DATE,
+        }) for med in medications]
     
-    # Add allergies
     allergies = patient_data.get('allergies', [])
     if allergies:
-        print(f"  Adding {len(allergies)} allergy(ies)...")
-        for allergy in allergies:
-            emr.add_allergy(
-                pid,
-                allergy['title'],
-                allergy.get('reaction', ''),
-                allergy.get('severity', '')
-            )
+        log.debug("  Adding %s allergy(ies)...", len(allergies))
+        issues += [('allergy', {
+            'title': allergy['title'],
+            'reaction': allergy.get('reaction', ''),
+            'severity': allergy.get('severity', ''),
+        }) for allergy in allergies]
+    
+    if issues:
+        emr.add_issues_bulk(pid, issues)
     
     # Update medical/social history
     history = patient_data.get('history', {})
     if history:
-        print(f"  Updating medical/social history...")
+        log.debug("  Updating medical/social history...")
         emr.update_history(pid, history)
     
     # Add insurance
     insurance = patient_data.get('insurance', {})
     if insurance:
-        print(f"  Adding insurance information...")
+        log.debug("  Adding insurance information...")
         emr.add_insurance(pid, insurance, "primary")
     
     # Create longitudinal encounters with vitals and labs
-    encounters = patient_data.get('encounters', [])
     if encounters:
-        print(f"  Creating {len(encounters)} encounter(s) with vitals/labs...")
+        log.debug("  Creating %s encounter(s) with vitals/labs...", len(encounters))
         for enc in encounters:
             enc_id = emr.create_encounter(
                 pid,
@@ -1019,67 +1511,174 @@ def import_patient_with_history(emr, patient_data):
                 if 'labs' in enc:
                     emr.add_lab_results(pid, enc_id, enc['labs'])
     
-    print(f"  ✓ Completed: {full_name} (PID: {pid})")
+    log.info("  ✓ Completed: %s (PID: %s)", full_name, pid)
     return pid
 
 
+def import_patients(emr, patients, workers=MAX_WORKERS, counts=None):
+    """
+    Import patients concurrently on a fixed set of worker threads.
+    
+    OpenEMR tracks the active patient/encounter in the PHP session, so each
+    worker owns its own logged-in web session for its whole lifetime. The
+    given session serves the first worker; the others log in when they start
+    and share its connection pool. If the given session persists its cookies,
+    each worker session keeps its own jar next to it (`<path>.<n>`), so
+    reruns reuse every worker's login rather than only the first. Like the
+    main session's, a restored worker jar is checked by login() and replaced
+    by a fresh login if it has gone stale. Patients are fed through a
+    bounded queue, so `patients` may be any iterable and is only read as
+    workers free up. A worker that cannot log in leaves its
+    share to the others; only if no worker has a session are the remaining
+    patients reported as failed.
+    
+    Args:
+        emr: Logged-in OpenEMRWebSession instance
+        patients: iterable of patient dicts
+        workers: Number of patients imported at the same time
+        counts: Optional Counter for the imported problems, medications and
+            encounters (see import_patient_with_history)
+        
+    Yields:
+        (name, pid) tuples as each patient finishes (pid is None for failures)
+    """
+    pending = queue.Queue(maxsize=workers * 2)
+    finished = queue.SimpleQueue()
+    feed_error = []
+    no_session = []
+    no_session_lock = threading.Lock()
+    
+    def worker(n):
+        try:
+            session = None
+            if n == 0:
+                session = emr
+            else:
+                cookie_jar_path = f"{emr.cookie_jar.filename}.{n}" if emr.cookie_jar is not None else None
+                try:
+                    session = OpenEMRWebSession(emr.base_url, emr.username, emr.password,
+                                                cookie_jar_path, adapter=emr.adapter)
+                    if not session.login():
+                        session = None
+                except Exception as e:
+                    log.error("  ✗ Worker session error: %s", e)
+                    session = None
+            if session is None:
+                with no_session_lock:
+                    no_session.append(n)
+                    last = len(no_session) == workers
+                if not last:
+                    log.warning("  ! Worker %s has no web session, leaving its patients to the others", n)
+                    return
+                # Nobody can import; drain the queue so feed() finishes
+                log.error("  ✗ No worker could log in, the remaining patients are not imported")
+            while True:
+                patient_data = pending.get()
+                if patient_data is None:
+                    return
+                # A malformed record becomes one failed result, not a dead worker
+                name = "(invalid record)"
+                pid = None
+                stats = Counter()
+                try:
+                    name = f"{patient_data.get('fname', '')} {patient_data.get('lname', '')}"
+                    if session is None:
+                        log.error("  ✗ Not imported (no web session): %s", name)
+                    else:
+                        pid = import_patient_with_history(session, patient_data, stats)
+                except Exception as e:
+                    log.error("  ✗ Import error: %s", e)
+                finished.put((name, pid, stats))
+        finally:
+            # Always report the exit, or the consuming loop below waits forever
+            finished.put(None)
+    
+    def feed():
+        try:
+            for patient_data in patients:
+                pending.put(patient_data)
+        except Exception as e:
+            feed_error.append(e)
+        finally:
+            for _ in range(workers):
+                pending.put(None)
+    
+    for n in range(workers):
+        threading.Thread(target=worker, args=(n,), daemon=True).start()
+    threading.Thread(target=feed, daemon=True).start()
+    
+    # Hand results back as they complete, until every worker has exited
+    running = workers
+    while running:
+        result = finished.get()
+        if result is None:
+            running -= 1
+            continue
+        name, pid, stats = result
+        if counts is not None:
+            counts.update(stats)
+        yield name, pid
+    if feed_error:
+        raise feed_error[0]
+
+
 # --- MAIN EXECUTION ---
 if __name__ == "__main__":
-    print("=" * 60)
-    print("  OpenEMR Combined Patient Import & Enrichment Script")
-    print("  With Longitudinal Data Support")
-    print("=" * 60)
+    setup_logging()
     
-    print("\nLoading patient data from JSONL file...")
-    PATIENTS = load_patients_from_jsonl()
+    log.info("=" * 60)
+    log.info("  OpenEMR Combined Patient Import & Enrichment Script")
+    log.info("  With Longitudinal Data Support")
+    log.info("=" * 60)
     
-    if not PATIENTS:
-        print("No patients to import. Check patients.jsonl file.")
+    log.info("\nReading patient data from JSONL file...")
+    patients_iter = iter_patients_from_jsonl()
+    first_patient = next(patients_iter, None)
+    
+    if first_patient is None:
+        log.error("No patients to import. Check patients.jsonl file.")
         exit(1)
     
-    print("\nInitializing Web Session...")
-    emr = OpenEMRWebSession(OPENEMR_URL, USERNAME, PASSWORD)
+    log.info("\nInitializing Web Session...")
+    emr = OpenEMRWebSession(OPENEMR_URL, USERNAME, PASSWORD, COOKIE_JAR_PATH)
     
-    print("Logging in...")
+    log.info("Logging in...")
     if not emr.login():
-        print("Failed to login!")
+        log.error("Failed to login!")
         exit(1)
     
-    print(f"\nStarting import of {len(PATIENTS)} patient(s)...")
-    print("Each patient includes: demographics, problems, medications,")
-    print("allergies, history, insurance, and longitudinal encounters.\n")
+    log.info("\nStarting import with %s worker(s)...", MAX_WORKERS)
+    log.info("Each patient includes: demographics, problems, medications,")
+    log.info("allergies, history, insurance, and longitudinal encounters.\n")
     
     results = {"success": [], "failed": []}
+    totals = Counter()
     
-    for patient in PATIENTS:
-        pid = import_patient_with_history(emr, patient)
-        name = f"{patient['fname']} {patient['lname']}"
+    patients = itertools.chain([first_patient], patients_iter)
+    for name, pid in import_patients(emr, patients, MAX_WORKERS, totals):
         if pid:
             results["success"].append((name, pid))
         else:
             results["failed"].append(name)
     
     # Summary
-    print("\n" + "=" * 60)
-    print("  IMPORT SUMMARY")
-    print("=" * 60)
-    print(f"  Successful: {len(results['success'])}")
+    log.info("\n" + "=" * 60)
+    log.info("  IMPORT SUMMARY")
+    log.info("=" * 60)
+    log.info("  Successful: %s", len(results['success']))
     for name, pid in results["success"]:
-        print(f"    - {name} (PID: {pid})")
+        log.info("    - %s (PID: %s)", name, pid)
     
     if results["failed"]:
-        print(f"  Failed: {len(results['failed'])}")
+        log.info("  Failed: %s", len(results['failed']))
         for name in results["failed"]:
-            print(f"    - {name}")
+            log.info("    - %s", name)
     
     # Stats
-    total_encounters = sum(len(p.get('encounters', [])) for p in PATIENTS)
-    total_problems = sum(len(p.get('problems', [])) for p in PATIENTS)
-    total_meds = sum(len(p.get('medications', [])) for p in PATIENTS)
-    print(f"\n  Data imported:")
-    print(f"    - {total_problems} medical problems")
-    print(f"    - {total_meds} medications")
-    print(f"    - {total_encounters} encounters with vitals")
-    
-    print("\n  Import Complete!")
+    log.info("\n  Data imported:")
+    log.info("    - %s medical problems", totals['problems'])
+    log.info("    - %s medications", totals['medications'])
+    log.info("    - %s encounters with vitals", totals['encounters'])
+    
+    log.info("\n  Import Complete!")
 